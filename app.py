@@ -1,9 +1,25 @@
 import os
 import asyncio
-from datetime import datetime, timedelta
-
+import bisect
+import hashlib
+import logging
+import logging.handlers
+import queue
+import time
+from array import array
+from collections import defaultdict, deque
+from itertools import accumulate
+
+import aiosqlite
+import httpx
+import orjson
+import tiktoken
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, Request
-from telegram import Update
+from fastapi.responses import ORJSONResponse
+from telegram import Message, Update
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -11,7 +27,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from groq import Groq
+from groq import AsyncGroq
 
 # =========================
 # CONFIG
@@ -21,57 +37,244 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "change-me")
 BASE_URL = os.getenv("BASE_URL")
+DB_PATH = os.getenv("DB_PATH", "bot.db")
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
 if not GROQ_API_KEY:
     raise RuntimeError("Missing GROQ_API_KEY")
 
+# One client for the whole process so TLS sessions and pooled connections are reused
+groq_client = AsyncGroq(
+    api_key=GROQ_API_KEY,
+    max_retries=2,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    ),
+)
+
+# =========================
+# LOGGING
+# =========================
+# Handlers only enqueue records; a listener thread does the blocking writes
+log = logging.getLogger("summarizer")
+log.setLevel(logging.INFO)
+log.propagate = False
+log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, _log_output)
+
 # =========================
 # STATE
 # =========================
-channel_messages = {}
+MAX_MESSAGES_PER_CHAT = 20000
+# Nothing older than this is ever summarized, so it isn't kept either
+RETENTION_SECONDS = 30 * 24 * 3600
+TRIM_BATCH = MAX_MESSAGES_PER_CHAT // 10
+
+
+def format_line(ts: float, text: str, user: str):
+    """Transcript line as fed to the LLM, or "" when there's no text."""
+    text = text.strip()
+    if not text:
+        return ""
+    # UTC HH:MM straight from epoch seconds, no datetime per line
+    minute = int(ts) // 60 % 1440
+    return f"[{minute // 60:02d}:{minute % 60:02d}] {user}: {text}"
+
+
+class ChatLog:
+    """Chat history, oldest first: epoch timestamps + pre-formatted transcript lines."""
+
+    __slots__ = ("timestamps", "lines")
+
+    def __init__(self, timestamps=None, lines=None):
+        self.timestamps = timestamps if timestamps is not None else array("d")
+        self.lines = lines if lines is not None else []
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, ts: float, text: str, user: str):
+        # Formatted once here so summaries don't redo it for every message
+        line = format_line(ts, text, user)
+        if self.timestamps and ts < self.timestamps[-1]:
+            # Rare late arrival: insert in place so bisect stays valid
+            i = bisect.bisect_right(self.timestamps, ts)
+            self.timestamps.insert(i, ts)
+            self.lines.insert(i, line)
+        else:
+            self.timestamps.append(ts)
+            self.lines.append(line)
+
+        # Expired history goes right away (a quiet chat may never reach the cap)
+        i = bisect.bisect_left(self.timestamps, ts - RETENTION_SECONDS)
+        if i:
+            del self.timestamps[:i]
+            del self.lines[:i]
+        # Over-cap history in batches so the O(N) shift is amortized over many appends
+        drop = len(self.timestamps) - MAX_MESSAGES_PER_CHAT
+        if drop > TRIM_BATCH:
+            del self.timestamps[:drop]
+            del self.lines[:drop]
+
+    def since(self, cutoff_ts: float):
+        # Never reach past retention, even if a trim hasn't caught up yet
+        cutoff_ts = max(cutoff_ts, time.time() - RETENTION_SECONDS)
+        i = bisect.bisect_left(self.timestamps, cutoff_ts)
+        return ChatLog(self.timestamps[i:], self.lines[i:])
+
+
+channel_messages = defaultdict(ChatLog)
 auto_summary_chats = set()
 
+# Recently processed update_ids, to drop Telegram's webhook retries
+SEEN_UPDATES_MAX = 4096
+seen_update_ids = deque(maxlen=SEEN_UPDATES_MAX)
+seen_update_set = set()
+
+# Outgoing message pacing, just under Telegram's limits
+# (~30 msg/s per bot, ~20 msg/min per group)
+global_send_limiter = AsyncLimiter(28, 1)
+chat_send_limiters = defaultdict(lambda: AsyncLimiter(19, 60))
+
+# Webhook backlog, drained by UPDATE_WORKERS tasks
+UPDATE_QUEUE_MAX = 1000
+UPDATE_WORKERS = 8
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_MAX)
+
+db = None
+write_queue = asyncio.Queue()
+background_tasks = set()
+
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_SECONDS = 0.1
+
+# (chat_id, hours, message count, last timestamp) -> summary text
+summary_cache = TTLCache(maxsize=512, ttl=300)
+summary_locks = {}
+# blake2b(block) -> partial summary, so unchanged blocks aren't re-summarized.
+# In-memory front for the persistent `partials` table.
+partial_cache = LRUCache(maxsize=1024)
+PARTIAL_RETENTION_SECONDS = 7 * 24 * 3600
+
 MAX_TG_LEN = 3500
 
+# Streaming replies: edit the status message at most this often, and only
+# once this many new characters arrived (Telegram rate-limits edits)
+STREAM_EDIT_SECONDS = 1.2
+STREAM_MIN_CHARS = 40
+
+# How often expired messages and partials are purged from SQLite
+PURGE_INTERVAL_SECONDS = 24 * 3600
+
+# Max in-flight Groq requests (keeps parallel partials under the RPM limit)
+GROQ_CONCURRENCY = 8
+groq_semaphore = asyncio.Semaphore(GROQ_CONCURRENCY)
+
+# BPE tokenizer for sizing prompts; chars/4 badly undercounts Cyrillic.
+# Loaded in the background at startup (the first use downloads the BPE file),
+# token_sizes estimates until then.
+TOKENIZER = None
+
+# Tokens per partial-summary block
+BLOCK_TOKENS = 3000
+# Blocks are aligned time spans (BLOCK_SPAN_SECONDS halved until they fit
+# BLOCK_TOKENS, down to BLOCK_BUCKET_SECONDS), so their boundaries depend only
+# on absolute time: as the window slides, the spans it still fully covers give
+# identical blocks and hit the partial cache
+BLOCK_BUCKET_SECONDS = 3600
+BLOCK_SPAN_SECONDS = BLOCK_BUCKET_SECONDS * 1024  # ~43 days, longer than retention
+
+# Up to this size (in tokens) the whole transcript goes into one LLM call.
+# Anything that fits a single block would otherwise get a partial + a reduce
+# over that one partial, so the threshold is at least BLOCK_TOKENS. The model
+# takes 128k tokens, but a request also has to fit the account's tokens-per-
+# minute limit (12k on Groq's free tier), hence the default; raise it on paid tiers.
+SINGLE_SHOT_TOKENS = max(BLOCK_TOKENS, int(os.getenv("SINGLE_SHOT_TOKENS", "8000")))
+
 
 # =========================
 # HELPERS
 # =========================
 def get_messages_by_timeframe(chat_id: int, hours: int):
-    messages = channel_messages.get(chat_id, [])
+    messages = channel_messages.get(chat_id)
     if not messages:
-        return []
+        return ChatLog()
 
-    tz = messages[-1]["timestamp"].tzinfo
-    now = datetime.now(tz=tz) if tz else datetime.now()
-    cutoff = now - timedelta(hours=hours)
-    return [m for m in messages if m["timestamp"] >= cutoff]
+    return messages.since(time.time() - hours * 3600)
 
 
-async def safe_reply(update: Update, text: str):
-    """Send long messages safely (Telegram limit)."""
-    if not text:
-        await update.message.reply_text("Пустой ответ от модели.")
-        return
-
+def split_message(text: str):
+    """Split text into Telegram-sized parts on paragraph boundaries."""
     if len(text) <= MAX_TG_LEN:
-        await update.message.reply_text(text)
-        return
+        return [text]
 
-    parts = []
-    buf = ""
+    # Greedy packing with a running length, joining each part once
+    parts, cur, cur_len = [], [], 0
     for block in text.split("\n\n"):
-        if len(buf) + len(block) + 2 <= MAX_TG_LEN:
-            buf = (buf + "\n\n" + block).strip()
+        block = block.strip()
+        if not block:
+            continue
+        # A single oversized paragraph is hard-cut so every part fits
+        while len(block) > MAX_TG_LEN:
+            if cur:
+                parts.append("\n\n".join(cur))
+                cur, cur_len = [], 0
+            parts.append(block[:MAX_TG_LEN])
+            block = block[MAX_TG_LEN:]
+
+        add = len(block) + (2 if cur else 0)
+        if cur and cur_len + add > MAX_TG_LEN:
+            parts.append("\n\n".join(cur))
+            cur, cur_len = [block], len(block)
         else:
-            parts.append(buf)
-            buf = block
-    if buf:
-        parts.append(buf)
+            cur.append(block)
+            cur_len += add
+    if cur:
+        parts.append("\n\n".join(cur))
+    return parts
+
+
+async def acquire_send_slot(chat_id: int):
+    """Wait until one more outgoing message fits Telegram's flood limits."""
+    await global_send_limiter.acquire()
+    await chat_send_limiters[chat_id].acquire()
+
+
+async def show_progress(status: Message, text: str):
+    """Best-effort edit of the status message with a partial answer."""
+    # Progress is optional: skip the edit rather than wait for the per-chat budget
+    limiter = chat_send_limiters[status.chat_id]
+    if not limiter.has_capacity():
+        return
+    await limiter.acquire()
+    try:
+        # The cursor also guarantees the final edit differs from the last progress one
+        await status.edit_text(text[: MAX_TG_LEN - 2] + " ▌")
+    except TelegramError:
+        pass
 
-    for p in parts:
+
+async def finish_reply(update: Update, status: Message, text: str):
+    """Put the final text into the status message; overflow goes to new messages."""
+    # Whitespace-only text would split into no parts at all
+    if not text.strip():
+        text = "Пустой ответ от модели."
+
+    first, *rest = split_message(text)
+    chat_id = update.effective_chat.id
+    await acquire_send_slot(chat_id)
+    try:
+        await status.edit_text(first)
+    except TelegramError:
+        await update.message.reply_text(first)
+    for p in rest:
+        await acquire_send_slot(chat_id)
         await update.message.reply_text(p)
 
 
@@ -79,36 +282,143 @@ async def run_with_timeout(coro, seconds=60):
     return await asyncio.wait_for(coro, timeout=seconds)
 
 
+def spawn(coro):
+    """Fire-and-forget a coroutine, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def update_worker():
+    while True:
+        update = await update_queue.get()
+        try:
+            await ptb.process_update(update)
+        except Exception:
+            log.exception("Update %s failed", update.update_id)
+        finally:
+            update_queue.task_done()
+
+
 # =========================
-# SUMMARY LOGIC
+# STORAGE
 # =========================
-async def generate_summary(messages):
-    lines = []
-    for m in messages:
-        txt = (m.get("text") or "").strip()
-        if txt:
-            lines.append(f"[{m['timestamp'].strftime('%H:%M')}] {m['user']}: {txt}")
+async def init_db():
+    global db
+    db = await aiosqlite.connect(DB_PATH)
+    await db.executescript(
+        """
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        CREATE TABLE IF NOT EXISTS messages(
+            chat_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            user TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_messages_chat_ts ON messages(chat_id, ts);
+        CREATE TABLE IF NOT EXISTS partials(
+            digest TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        """
+    )
+    await purge_expired()
 
-    if not lines:
-        return "Нет текстовых сообщений."
+    # Memory stays the hot path; the DB only repopulates it after a restart
+    async with db.execute(
+        "SELECT chat_id, ts, user, text FROM messages ORDER BY chat_id, ts"
+    ) as cur:
+        async for chat_id, ts, user, text in cur:
+            channel_messages[chat_id].append(ts, text, user)
 
-    # Chunking
-    blocks, cur, size = [], [], 0
-    for line in lines:
-        est = max(1, len(line) // 4)
-        if cur and size + est > 3000:
-            blocks.append("\n".join(cur))
-            cur, size = [line], est
-        else:
-            cur.append(line)
-            size += est
-    if cur:
-        blocks.append("\n".join(cur))
 
-    client = Groq(api_key=GROQ_API_KEY)
-    partials = []
+async def purge_expired():
+    """Drop messages past retention and cached partials older than a week."""
+    now = time.time()
+    await db.execute("DELETE FROM messages WHERE ts < ?", (now - RETENTION_SECONDS,))
+    await db.execute("DELETE FROM partials WHERE created < ?", (now - PARTIAL_RETENTION_SECONDS,))
+    await db.commit()
+
+
+async def purge_loop():
+    """Re-run purge_expired periodically (init_db already ran it at startup)."""
+    while True:
+        await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+        try:
+            await purge_expired()
+        except Exception:
+            log.exception("Purge failed")
+
 
-    partial_prompt = """Выжимка ЧАСТИ чата.
+async def load_partial(digest: str):
+    async with db.execute("SELECT summary FROM partials WHERE digest = ?", (digest,)) as cur:
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def save_partial(digest: str, summary: str):
+    await db.execute(
+        "INSERT OR REPLACE INTO partials(digest, summary, created) VALUES(?, ?, ?)",
+        (digest, summary, time.time()),
+    )
+    await db.commit()
+
+
+async def write_rows(rows):
+    await db.executemany(
+        "INSERT INTO messages(chat_id, ts, user, text) VALUES(?, ?, ?, ?)", rows
+    )
+    await db.commit()
+
+
+async def writer_loop():
+    """Drain write_queue into SQLite, one transaction per batch; None stops it."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await write_queue.get()
+        if row is None:
+            return
+        rows = [row]
+        deadline = loop.time() + WRITE_FLUSH_SECONDS
+        while len(rows) < WRITE_BATCH_SIZE:
+            try:
+                row = write_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(write_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if row is None:
+                # Write what we have, then stop
+                stopping = True
+                break
+            rows.append(row)
+
+        try:
+            await write_rows(rows)
+        except Exception as e:
+            log.error("DB write failed (%d rows): %s", len(rows), e)
+
+
+async def flush_write_queue():
+    rows = []
+    while not write_queue.empty():
+        rows.append(write_queue.get_nowait())
+    if rows:
+        await write_rows(rows)
+
+
+# =========================
+# PROMPTS
+# =========================
+PARTIAL_PROMPT = """Выжимка ЧАСТИ чата.
 
 Правила:
 - Не выдумывай.
@@ -123,18 +433,10 @@ async def generate_summary(messages):
 Рекомендации:
 Ссылки:
 Планы:
-"""
 
-    for b in blocks:
-        r = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            temperature=0.2,
-            max_tokens=700,
-            messages=[{"role": "user", "content": partial_prompt + "\n" + b}],
-        )
-        partials.append(r.choices[0].message.content)
+"""
 
-    final_prompt = f"""Сделай сторителлинг-саммари дня по переписке.
+FINAL_PROMPT = """Сделай сторителлинг-саммари дня по переписке.
 
 Тон:
 - без приветствий и пожеланий
@@ -164,33 +466,227 @@ async def generate_summary(messages):
 — или "— не было"
 
 Материал:
-{chr(10).join(partials)}
 """
 
-    res = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        temperature=0.5,
-        max_tokens=1100,
-        messages=[{"role": "user", "content": final_prompt}],
-    )
-    return res.choices[0].message.content
+
+# =========================
+# SUMMARY LOGIC
+# =========================
+def split_blocks(lines, sizes, limit=BLOCK_TOKENS):
+    """Greedily pack lines into blocks of at most `limit` tokens."""
+    cum = list(accumulate(sizes))
+    blocks, start, base = [], 0, 0
+    while start < len(lines):
+        # First line whose running total overflows the block (at least one line per block)
+        end = max(bisect.bisect_right(cum, base + limit, lo=start), start + 1)
+        blocks.append("\n".join(lines[start:end]))
+        base = cum[end - 1]
+        start = end
+    return blocks
+
+
+def split_time_blocks(stamps, lines, sizes):
+    """Pack time-sorted lines into blocks along aligned time spans."""
+    cum = [0, *accumulate(sizes)]
+
+    def pack(lo, hi, t0, width):
+        # lines[lo:hi] are the ones in [t0, t0 + width)
+        if cum[hi] - cum[lo] <= BLOCK_TOKENS:
+            return ["\n".join(lines[lo:hi])] if hi > lo else []
+        if width <= BLOCK_BUCKET_SECONDS:
+            return split_blocks(lines[lo:hi], sizes[lo:hi])
+        half = width // 2
+        mid = bisect.bisect_left(stamps, t0 + half, lo, hi)
+        return pack(lo, mid, t0, half) + pack(mid, hi, t0 + half, half)
+
+    blocks, lo = [], 0
+    while lo < len(lines):
+        t0 = stamps[lo] // BLOCK_SPAN_SECONDS * BLOCK_SPAN_SECONDS
+        hi = bisect.bisect_left(stamps, t0 + BLOCK_SPAN_SECONDS, lo)
+        blocks += pack(lo, hi, t0, BLOCK_SPAN_SECONDS)
+        lo = hi
+    return blocks
+
+
+def partial_request(block: str):
+    return {
+        "model": "llama-3.3-70b-versatile",
+        "temperature": 0.2,
+        "max_tokens": 700,
+        "messages": [{"role": "user", "content": PARTIAL_PROMPT + block}],
+    }
+
+
+def final_request(material: str):
+    return {
+        "model": "llama-3.3-70b-versatile",
+        "temperature": 0.5,
+        "max_tokens": 1100,
+        "messages": [{"role": "user", "content": FINAL_PROMPT + material}],
+    }
+
+
+def block_digest(block: str):
+    return hashlib.blake2b(block.encode(), digest_size=16).hexdigest()
+
+
+async def cached_partial(digest: str):
+    partial = partial_cache.get(digest)
+    if partial is None:
+        partial = await load_partial(digest)
+        if partial is not None:
+            partial_cache[digest] = partial
+    return partial
+
+
+async def store_partial(digest: str, partial: str):
+    partial_cache[digest] = partial
+    await save_partial(digest, partial)
+
+
+async def load_tokenizer():
+    global TOKENIZER
+    try:
+        TOKENIZER = await asyncio.to_thread(tiktoken.get_encoding, "cl100k_base")
+    except Exception as e:
+        log.warning("Tokenizer unavailable, estimating tokens as chars/4: %s", e)
+
+
+def token_sizes(texts):
+    if TOKENIZER is None:
+        return [len(t) // 4 or 1 for t in texts]
+    return [len(TOKENIZER.encode_ordinary(t)) or 1 for t in texts]
+
+
+def plan_summary(messages: ChatLog):
+    """Transcript lines, plus the map-stage blocks (None when one call is enough)."""
+    kept = [(ts, line) for ts, line in zip(messages.timestamps, messages.lines) if line]
+    stamps = [ts for ts, _ in kept]
+    lines = [line for _, line in kept]
+    if not lines:
+        return lines, None
+
+    sizes = token_sizes(lines)
+    if sum(sizes) <= SINGLE_SHOT_TOKENS:
+        # Small chat: the raw transcript fits the final prompt, skip the map stage
+        return lines, None
+
+    return lines, split_time_blocks(stamps, lines, sizes)
+
+
+async def summarize_block(block: str):
+    digest = block_digest(block)
+    partial = await cached_partial(digest)
+    if partial is None:
+        async with groq_semaphore:
+            r = await groq_client.chat.completions.create(**partial_request(block))
+        partial = r.choices[0].message.content
+        await store_partial(digest, partial)
+    return partial
+
+
+async def reduce_partials(partials):
+    """Merge partials in extra rounds until together they fit the final prompt."""
+    while len(partials) > 1:
+        sizes = token_sizes(partials)
+        if sum(sizes) <= SINGLE_SHOT_TOKENS:
+            break
+        # Each group of a block's worth of partials collapses into one
+        groups = split_blocks(partials, sizes)
+        if len(groups) == len(partials):
+            # Every partial fills a block alone: pair them so each round still shrinks
+            groups = ["\n".join(partials[i : i + 2]) for i in range(0, len(partials), 2)]
+        partials = await asyncio.gather(*(summarize_block(g) for g in groups))
+    return partials
+
+
+async def generate_summary(messages: ChatLog, on_progress=None):
+    """Summarize messages; on_progress(text) gets the final answer as it streams."""
+    lines, blocks = plan_summary(messages)
+    if not lines:
+        return "Нет текстовых сообщений."
+
+    if blocks is None:
+        material = "\n".join(lines)
+    else:
+        # Partials are independent: fire them together, gather keeps block order.
+        partials = await asyncio.gather(*(summarize_block(b) for b in blocks))
+        material = "\n".join(await reduce_partials(partials))
+
+    # The final calls share the Groq concurrency cap with the partials, so
+    # summaries running in many chats at once can't burst past the rate limit either
+    async with groq_semaphore:
+        if on_progress is None:
+            res = await groq_client.chat.completions.create(**final_request(material))
+            return res.choices[0].message.content
+
+        stream = await groq_client.chat.completions.create(
+            **final_request(material), stream=True
+        )
+        pieces, size, shown, last_edit = [], 0, 0, 0.0
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            pieces.append(delta)
+            size += len(delta)
+
+            # Only edit when the visible text grew; past MAX_TG_LEN the status
+            # message can't show more, so the rest waits for the final reply
+            now = time.monotonic()
+            if (
+                shown < MAX_TG_LEN
+                and size - shown >= STREAM_MIN_CHARS
+                and now - last_edit >= STREAM_EDIT_SECONDS
+            ):
+                shown, last_edit = size, now
+                await on_progress("".join(pieces))
+    return "".join(pieces)
+
+
+def summary_key(chat_id: int, hours: int, messages: ChatLog):
+    return (chat_id, hours, len(messages), messages.timestamps[-1])
+
+
+async def cached_summary(chat_id: int, hours: int, messages: ChatLog, on_progress=None):
+    """generate_summary, reusing the result while the message window is unchanged."""
+    key = summary_key(chat_id, hours, messages)
+    text = summary_cache.get(key)
+    if text is not None:
+        return text
+
+    # Single-flight: concurrent requests for the same window wait for the first one
+    lock = summary_locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            text = summary_cache.get(key)
+            if text is None:
+                text = await generate_summary(messages, on_progress)
+                summary_cache[key] = text
+    finally:
+        if not lock.locked():
+            summary_locks.pop(key, None)
+    return text
 
 
 # =========================
 # HANDLERS
 # =========================
 async def collect_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Commands, edits and text-less messages are filtered out at registration
     msg = update.message or update.channel_post
-    if not msg or (msg.text and msg.text.startswith("/")):
+    if not msg:
         return
 
-    channel_messages.setdefault(msg.chat.id, []).append(
-        {
-            "text": msg.text or msg.caption or "",
-            "timestamp": msg.date,
-            "user": msg.from_user.first_name if msg.from_user else "Channel",
-        }
-    )
+    chat_id = msg.chat.id
+    ts = msg.date.timestamp()
+    text = msg.text or msg.caption or ""
+    if not text.strip():
+        return
+    user = msg.from_user.first_name if msg.from_user else "Channel"
+
+    channel_messages[chat_id].append(ts, text, user)
+    write_queue.put_nowait((chat_id, ts, user, text))
 
 
 async def summary_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -200,7 +696,7 @@ async def summary_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пример: /summary_custom 1")
         return
 
-    await update.message.reply_text(f"⏳ Делаю саммари за {hours}ч...")
+    status = await update.message.reply_text(f"⏳ Делаю саммари за {hours}ч...")
 
     try:
         msgs = get_messages_by_timeframe(update.effective_chat.id, hours)
@@ -208,8 +704,15 @@ async def summary_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Нет сообщений.")
             return
 
-        text = await run_with_timeout(generate_summary(msgs))
-        await safe_reply(update, text)
+        text = await run_with_timeout(
+            cached_summary(
+                update.effective_chat.id,
+                hours,
+                msgs,
+                on_progress=lambda t: show_progress(status, t),
+            )
+        )
+        await finish_reply(update, status, text)
 
     except asyncio.TimeoutError:
         await update.message.reply_text("Groq не ответил вовремя. Попробуй меньший период.")
@@ -225,30 +728,88 @@ async def summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # FASTAPI
 # =========================
-app = FastAPI()
-ptb = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+app = FastAPI(default_response_class=ORJSONResponse)
+# HTTP/2 to the Bot API: concurrent sends multiplex over one connection
+ptb = Application.builder().token(TELEGRAM_BOT_TOKEN).http_version("2").build()
 
 
 @app.on_event("startup")
 async def startup():
-    ptb.add_handler(CommandHandler("summary", summary_command))
-    ptb.add_handler(CommandHandler("summary_custom", summary_custom))
-    ptb.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, collect_message))
+    log_listener.start()
+    spawn(load_tokenizer())
+    await init_db()
+    app.state.writer = spawn(writer_loop())
+
+    # Summaries take seconds: run them outside the update workers (block=False)
+    ptb.add_handler(CommandHandler("summary", summary_command, block=False))
+    ptb.add_handler(CommandHandler("summary_custom", summary_custom, block=False))
+    # Only messages with something to summarize; stickers, bare media and
+    # service events (joins, pins, ...) never reach collect_message
+    ptb.add_handler(
+        MessageHandler(
+            (filters.TEXT | filters.CAPTION) & ~filters.COMMAND & ~filters.UpdateType.EDITED,
+            collect_message,
+        )
+    )
 
     await ptb.initialize()
     await ptb.start()
 
+    app.state.purger = spawn(purge_loop())
+    app.state.workers = [spawn(update_worker()) for _ in range(UPDATE_WORKERS)]
+
     if BASE_URL:
-        await ptb.bot.set_webhook(f"{BASE_URL}/telegram/{WEBHOOK_SECRET}")
+        await ptb.bot.set_webhook(
+            f"{BASE_URL}/telegram/{WEBHOOK_SECRET}", max_connections=100
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Finish the acknowledged backlog before PTB goes away
+    await update_queue.join()
+    for worker in app.state.workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.workers, return_exceptions=True)
+    # Waits for the block=False summary handlers too
+    await ptb.stop()
+    await ptb.shutdown()
+    # No periodic job may still be using the clients closed below
+    app.state.purger.cancel()
+    await asyncio.gather(app.state.purger, return_exceptions=True)
+    await groq_client.close()
+    if db is not None:
+        # Let the writer finish its current batch instead of cancelling mid-commit
+        write_queue.put_nowait(None)
+        await app.state.writer
+        await flush_write_queue()
+        await db.close()
+    log_listener.stop()
 
 
 @app.post("/telegram/{secret}")
 async def telegram_webhook(secret: str, request: Request):
     if secret != WEBHOOK_SECRET:
         return {"ok": False}
-    data = await request.json()
+    data = orjson.loads(await request.body())
+
+    # Check retries on the raw payload, before paying for Update.de_json
+    uid = data.get("update_id")
+    if uid in seen_update_set:
+        return {"ok": True}
     update = Update.de_json(data, ptb.bot)
-    await ptb.process_update(update)
+
+    # Ack right away: a /summary can take longer than Telegram's retry timeout.
+    # When the backlog is full, let Telegram redeliver later instead.
+    try:
+        update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        return ORJSONResponse({"ok": False}, status_code=429)
+
+    if len(seen_update_ids) == SEEN_UPDATES_MAX:
+        seen_update_set.discard(seen_update_ids[0])
+    seen_update_ids.append(uid)
+    seen_update_set.add(uid)
     return {"ok": True}
 
 